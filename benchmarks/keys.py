@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# Compare per call cost of building a key with a lambda, and with a
+# compiled key template. Redis is not needed.
+import sys
+import timeit
+from os import path
+
+from django.conf import settings
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+settings.configure(CACHEME={'ENABLE_CACHE': True, 'REDIS_CACHE_PREFIX': 'CM:'})
+
+from django_cacheme.cache_model import CacheMe  # noqa: E402
+from django_cacheme.utils import split_key  # noqa: E402
+
+
+class Book(object):
+    id = 100
+
+
+def get_owner(self, obj):
+    pass
+
+
+def lambda_key(instance, container):
+    key = instance.key_prefix + instance.key(container)
+    return key, split_key(key)
+
+
+def template_key(instance, container):
+    return instance.get_cache_key(container)
+
+
+def main():
+    number = 200000
+    book = Book()
+    by_lambda = CacheMe(key=lambda c: 'Book:%s>owner' % c.obj.id)
+    by_lambda(get_owner)
+    by_template = CacheMe(key='Book:{obj.id}>owner')
+    by_template(get_owner)
+
+    container = by_lambda.get_container((None, book), {})
+    assert lambda_key(by_lambda, container) == (template_key(by_template, container)[0], ['CM:Book:100', 'owner'])
+
+    for name, func, instance in [('lambda', lambda_key, by_lambda), ('template', template_key, by_template)]:
+        seconds = timeit.timeit(lambda: func(instance, container), number=number)
+        print('%-14s %.3f us/call' % (name, seconds / number * 1e6))
+
+    seconds = timeit.timeit(lambda: type('Container', (), {'self': None, 'obj': book}), number=number // 10)
+    print('%-14s %.3f us/call' % ('old container', seconds / number * 10 * 1e6))
+    seconds = timeit.timeit(lambda: by_template.get_container((None, book), {}), number=number)
+    print('%-14s %.3f us/call' % ('container', seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
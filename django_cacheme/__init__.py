@@ -1 +1,2 @@
 from .cache_model import cacheme_tags, CacheMe as cacheme
+from .warm import warm
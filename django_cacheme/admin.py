@@ -1,7 +1,17 @@
 from django import forms
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
 from .models import Invalidation
 from .cache_model import cacheme_tags
+from .hotkeys import hot_keys_report
+from .keyspace import inspect_keyspace
+from .utils import CACHEME
+
+try:
+    from django.urls import re_path
+except ImportError:  # Django 1.11
+    from django.conf.urls import url as re_path
 
 
 def get_cache_tags():
@@ -46,3 +56,44 @@ class InvalidationAdmin(admin.ModelAdmin):
         tags = form.cleaned_data['invalid_tags']
         obj.tags = ','.join(tags)
         super().save_model(request, obj, form, change)
+
+    def get_urls(self):
+        urls = [
+            re_path(
+                r'^hot-keys/$',
+                self.admin_site.admin_view(self.hot_keys_view),
+                name='django_cacheme_hot_keys'
+            ),
+            re_path(
+                r'^keyspace/$',
+                self.admin_site.admin_view(self.keyspace_view),
+                name='django_cacheme_keyspace'
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def hot_keys_view(self, request):
+        # cache keys can contain private data, staff alone is not enough
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Hot keys',
+            report=hot_keys_report(),
+        )
+        return TemplateResponse(request, 'admin/django_cacheme/hot_keys.html', context)
+
+    def keyspace_view(self, request):
+        # shows cache keys and runs scans on redis, staff alone is not enough
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        # delete and invalid sets are scanned only on request, they can be many
+        sets = 'sets' in request.GET
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Keyspace',
+            sample=CACHEME.INSPECT_SAMPLE_SIZE,
+            max_sets=CACHEME.INSPECT_MAX_SETS,
+            report=inspect_keyspace(sample=CACHEME.INSPECT_SAMPLE_SIZE, sets=sets),
+        )
+        return TemplateResponse(request, 'admin/django_cacheme/keyspace.html', context)
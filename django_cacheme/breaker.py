@@ -0,0 +1,153 @@
+import time
+import logging
+import threading
+
+from collections import deque
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger('cacheme')
+
+
+class CacheUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    # per process breaker around redis calls. After threshold consecutive
+    # errors (or slow calls) it opens and rejects calls at once, after
+    # reset_timeout seconds one probe call is let through (half-open),
+    # success closes it again and replays deferred calls
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold, latency=0, reset_timeout=5, queue_size=1000, on_overflow=None):
+        self.threshold = threshold
+        self.latency = latency
+        self.reset_timeout = reset_timeout
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.on_overflow = on_overflow
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.overflowed = False
+        self.queue.clear()
+        self.metrics = dict.fromkeys(
+            ('calls', 'errors', 'slow', 'rejected', 'opened', 'deferred', 'replayed'), 0
+        )
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+        return False
+
+    def success(self):
+        # no lock on the usual path, one call per redis call
+        if self.state == self.CLOSED and not self.failures and not self.queue and not self.overflowed:
+            return
+        with self.lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                logger.warning('[CACHEME BREAKER LOG] redis recovered, breaker closed')
+            self.state = self.CLOSED
+        if self.queue or self.overflowed:
+            self.replay()
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.metrics['opened'] += 1
+                    logger.warning('[CACHEME BREAKER LOG] redis unavailable, breaker open')
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+    def abort(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        if not self.threshold:
+            return func(*args, **kwargs)
+        if not self.allow():
+            self.metrics['rejected'] += 1
+            raise CacheUnavailable()
+
+        self.metrics['calls'] += 1
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except RedisError as e:
+            self.metrics['errors'] += 1
+            self.failure()
+            raise CacheUnavailable() from e
+        except BaseException:
+            # not a redis error, so health is unknown, a probe opens again
+            self.abort()
+            raise
+
+        if self.latency and (time.monotonic() - start) * 1000 > self.latency:
+            self.metrics['slow'] += 1
+            self.failure()
+        else:
+            self.success()
+        return result
+
+    def defer(self, func, *args):
+        # queue a call which must not be lost, replayed when redis recovers.
+        # if queue is full, calls are dropped and on_overflow is replayed instead
+        with self.lock:
+            self.metrics['deferred'] += 1
+            if len(self.queue) >= self.queue_size:
+                logger.error('[CACHEME BREAKER LOG] replay queue full, will flush cache on recovery')
+                self.queue.clear()
+                self.overflowed = True
+            if not self.overflowed:
+                self.queue.append((func, args))
+
+    def replay(self):
+        with self.lock:
+            overflowed, self.overflowed = self.overflowed, False
+            calls = list(self.queue)
+            self.queue.clear()
+        try:
+            if overflowed and self.on_overflow:
+                self.on_overflow()
+            overflowed = False
+            while calls:
+                func, args = calls[0]
+                try:
+                    func(*args)
+                except RedisError:
+                    raise
+                except Exception:
+                    # not a redis error, would fail again, so the rest is still replayed
+                    logger.exception('[CACHEME BREAKER LOG] replay of %s failed' % getattr(func, '__name__', func))
+                calls.pop(0)
+                self.metrics['replayed'] += 1
+        except RedisError:
+            with self.lock:
+                self.overflowed = self.overflowed or overflowed
+                self.queue.extendleft(reversed(calls))
+            self.failure()
+
+    def guard(self, func, *args):
+        # run a call which must not be lost, defer it if redis is unavailable
+        try:
+            self.call(func, *args)
+        except CacheUnavailable:
+            self.defer(func, *args)
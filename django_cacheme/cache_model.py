@@ -1,29 +1,137 @@
+import os
 import time
+import zlib
 import pickle
 import datetime
 import logging
+import threading
 
 from functools import wraps
+from concurrent.futures import Future
+from importlib import import_module
+from django.db import connections, transaction, close_old_connections
 from django.db.models.signals import m2m_changed, post_delete, post_save
-from django_redis import get_redis_connection
 from inspect import _signature_from_function, Signature
 
-from .utils import split_key, invalid_cache, flat_list, CACHEME
+from .utils import (
+    split_key, compile_key, template_fields, chunk_field, invalid_cache, flat_list, to_call, get_redis_conn, ChunkReader, breaker,
+    mark_deleted, CACHEME
+)
+from .breaker import CacheUnavailable
+from .hotkeys import HotKeySampler
+from .tracking import record_reads, record_entry, enable_tracking
+from . import executors
+from .executors import submit
 
 
 logger = logging.getLogger('cacheme')
 
 cacheme_tags = dict()
 
+# tags can be shared, so process pool workers find functions by module and qualname
+cacheme_functions = dict()
+
+# pickled values start with protocol opcode b'\x80', large values written
+# with a policy start with one of these markers instead
+COMPRESSED = b'Z'
+CHUNKED = b'C'
+
+LARGE_VALUE_POLICIES = ('skip', 'compress', 'chunk')
+
+EXECUTORS = (None, 'thread', 'process')
+
+
+# pid whose state is current, a forked pool worker resets inherited state first
+forked = {'pid': os.getpid()}
+
+# database connections inherited from parent, kept referenced, because
+# closing them would also end the parent's sessions
+inherited_connections = []
+
+
+def reset_after_fork():
+    # a forked worker is a copy of the thread which forked it, with copies of
+    # locks and pending futures held by other threads, never released here
+    pid = os.getpid()
+    if forked['pid'] == pid:
+        return
+    forked['pid'] = pid
+    for cacheme in set(cacheme_functions.values()):
+        cacheme.flights = {}
+        cacheme.flights_lock = threading.Lock()
+        cacheme.refreshing = set()
+        cacheme.refresh_lock = threading.Lock()
+        if cacheme.sampler:
+            cacheme.sampler.lock = threading.Lock()
+    breaker.lock = threading.Lock()
+    executors.lock = threading.Lock()
+    pending.entries = {}
+    for alias in connections:
+        inherited_connections.append(connections[alias])
+        del connections[alias]
+
+
+def call_function(name, args, kwargs):
+    # run in process pool workers, decorated function itself can not be pickled
+    reset_after_fork()
+    if name not in cacheme_functions:
+        import_module(name[0])
+    return cacheme_functions[name].run(args, kwargs)
+
+
+class Container(object):
+
+    def __init__(self, arguments):
+        self.__dict__.update(arguments)
+
+# (signal, model, receiver) already connected, many decorators share
+# the same invalid models, so connect each only once
+linked_signals = set()
+
+# model -> decorators refreshed on its post_save
+refreshers = dict()
+
+# refreshes of current thread waiting for commit, cache key -> entry
+pending = threading.local()
+
+
+def connect_signal(signal, model, receiver=invalid_cache):
+    if (signal, model, receiver) in linked_signals:
+        return
+    signal.connect(receiver, model)
+    linked_signals.add((signal, model, receiver))
+
+
+def refresh_cache(sender, instance, using=None, **kwargs):
+    if not CACHEME.ENABLE_CACHE:
+        return
+    for cacheme in refreshers.get(sender, ()):
+        cacheme.schedule_refresh(sender, instance)
+    transaction.on_commit(flush_refreshes, using=using)
+
+
+def flush_refreshes():
+    # entries of a rolled back transaction stay until next flush, and are
+    # just recomputed from committed data then
+    entries = getattr(pending, 'entries', None)
+    if not entries:
+        return
+    pending.entries = {}
+    groups = {}
+    for cacheme, entry in entries.values():
+        groups.setdefault(cacheme, []).append(entry)
+    for cacheme, group in groups.items():
+        cacheme.refresh(group)
+
 
 class CacheMe(object):
     key_prefix = CACHEME.REDIS_CACHE_PREFIX
     deleted = key_prefix + 'delete'
 
-    def __init__(self, key, invalid_keys=None, invalid_models=(), invalid_m2m_models=(), hit=None, miss=None, tag=None, skip=False, timeout=None):
-        if not CACHEME.ENABLE_CACHE:
-            return
+    def __init__(self, key, invalid_keys=None, invalid_models=(), invalid_m2m_models=(), hit=None, miss=None, tag=None, skip=False, timeout=None, max_size=None, large_value=None, track_reads=False, executor=None, refresh_on=None, refresh_mode='commit'):
         self.key = key
+        # string key is a template, compiled once here
+        self.build_key = compile_key(key, self.key_prefix) if isinstance(key, str) else None
         self.invalid_keys = invalid_keys
         self.invalid_models = invalid_models
         self.invalid_m2m_models = invalid_m2m_models
@@ -32,73 +140,124 @@ class CacheMe(object):
         self.tag = tag
         self.skip = skip
         self.timeout = timeout
+        self.max_size = CACHEME.MAX_VALUE_SIZE if max_size is None else max_size
+        self.large_value = large_value or CACHEME.LARGE_VALUE_POLICY
+        if self.large_value not in LARGE_VALUE_POLICIES:
+            raise ValueError(
+                'Unknown large_value "%s", use one of: %s' % (self.large_value, ', '.join(LARGE_VALUE_POLICIES))
+            )
+        self.track_reads = track_reads
+        if executor not in EXECUTORS:
+            raise ValueError('Unknown executor "%s", use None, "thread" or "process"' % executor)
+        self.executor = executor
+        # in process misses, key -> future of the call computing it
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+        self.refresh_on = refresh_on or {}
+        self.refresh_mode = refresh_mode
+        # keys waiting in background pool
+        self.refreshing = set()
+        self.refresh_lock = threading.Lock()
         self.progress_key = self.key_prefix + 'progress'
 
-        self.conn = get_redis_connection(CACHEME.REDIS_CACHE_ALIAS)
+        # redis connection is resolved on first use, not at import time,
+        # but signals are connected now, so invalidation never misses a save
         self.link()
+        if track_reads:
+            enable_tracking()
+
+    @property
+    def conn(self):
+        return get_redis_conn()
 
     def __call__(self, func):
 
         self.function = func
+        self.signature = _signature_from_function(Signature, func)
+
+        if self.build_key:
+            unknown = template_fields(self.key) - set(self.signature.parameters)
+            if unknown:
+                raise ValueError(
+                    'Key template "%s" uses unknown arguments: %s' % (self.key, ', '.join(sorted(unknown)))
+                )
 
         self.tag = self.tag or func.__name__
         cacheme_tags[self.tag] = self
+        self.name = (func.__module__, func.__qualname__)
+        cacheme_functions[self.name] = self
+        self.sampler = HotKeySampler(self.tag) if CACHEME.HOT_KEY_SAMPLE_RATE else None
 
         @wraps(func)
         def wrapper(*args, **kwargs):
             if not CACHEME.ENABLE_CACHE:
                 return self.function(*args, **kwargs)
 
-            # bind args and kwargs to true function params
-            signature = _signature_from_function(Signature, func)
-            bind = signature.bind(*args, **kwargs)
-            bind.apply_defaults()
-
-            # then apply args and kwargs to a container,
-            # in this way, we can have clear lambda with just one
-            # argument, and access what we need from this container
-            self.container = type('Container', (), bind.arguments)
+            container = self.get_container(args, kwargs)
 
-            if callable(self.skip) and self.skip(self.container):
+            if self.should_skip(container):
                 return self.function(*args, **kwargs)
-            elif self.skip:
-                return self.function(*args, **kwargs)
-
-            key = self.key_prefix + self.key(self.container)
 
-            if self.conn.srem(self.deleted, key):
-                result = self.function(*args, **kwargs)
-                self.set_result(key, result)
-                self.container.cacheme_result = result
-                self.add_to_invalid_list(key, args, kwargs)
+            key, parts = self.get_cache_key(container)
+            record_entry(key)
+
+            if self.sampler:
+                self.sampler.add(key)
+                result = self.sampler.get_local(key)
+                if result is not None:
+                    if self.hit:
+                        self.hit(key, result, container)
+                    return result
+
+            try:
+                deleted = breaker.call(self.conn.srem, self.deleted, key)
+                result = None if deleted else breaker.call(self.get_key, key, parts)
+            except CacheUnavailable:
+                return self.get_degraded(args, kwargs, key, container)
+
+            if deleted:
+                try:
+                    result = self.compute(args, kwargs, container)
+                except BaseException:
+                    # old value is still stored, so delete mark must come back
+                    breaker.guard(self.add_to_deleted, key)
+                    raise
+                self.save_result(key, parts, result, container, deleted=True)
                 return result
 
-            result = self.get_key(key)
-
             if result is None:
-
-                if self.add_to_progress(key) == 0:  # already in progress
-                    for i in range(CACHEME.THUNDERING_HERD_RETRY_COUNT):
-                        time.sleep(CACHEME.THUNDERING_HERD_RETRY_TIME/1000)
-                        result = self.get_key(key)
-                        if result:
-                            return result
-
-                result = self.get_result_from_func(args, kwargs, key)
-                self.set_result(key, result)
-                self.remove_from_progress(key)
-                self.container.cacheme_result = result
-                self.add_to_invalid_list(key, args, kwargs)
+                result = self.single_flight(key, self.get_missing, args, kwargs, key, parts, container)
             else:
+                self.set_local(key, result)
                 if self.hit:
-                    self.hit(key, result, self.container)
-                result = result
+                    self.hit(key, result, container)
 
-            self.container = None
             return result
 
         return wrapper
 
+    def get_container(self, args, kwargs):
+        # bind args and kwargs to true function params
+        bind = self.signature.bind(*args, **kwargs)
+        bind.apply_defaults()
+
+        # then apply args and kwargs to a container,
+        # in this way, we can have clear lambda with just one
+        # argument, and access what we need from this container.
+        # container is local to each call, so threads never share it
+        return Container(bind.arguments)
+
+    def get_cache_key(self, container):
+        # return full key, and (main key, field) if known without a split
+        if self.build_key:
+            return self.build_key(container.__dict__)
+        return self.key_prefix + self.key(container), None
+
+    def should_skip(self, container):
+        if callable(self.skip) and self.skip(container):
+            return True
+        return bool(self.skip)
+
     @property
     def keys(self):
         return self.conn.smembers(CACHEME.REDIS_CACHE_PREFIX + self.tag)
@@ -108,18 +267,21 @@ class CacheMe(object):
         self.conn.sadd(CACHEME.REDIS_CACHE_PREFIX + self.tag, val)
 
     def invalid_all(self):
+        breaker.guard(self.invalid_tag)
+
+    def invalid_tag(self):
         keys = self.keys
         if not keys:
             return
-        self.conn.sadd(self.deleted, *keys)
+        mark_deleted(keys, self.conn)
         self.conn.unlink(CACHEME.REDIS_CACHE_PREFIX + self.tag)
 
-    def get_result_from_func(self, args, kwargs, key):
+    def get_result_from_func(self, args, kwargs, key, container):
         if self.miss:
-            self.miss(key, self.container)
+            self.miss(key, container)
 
         start = datetime.datetime.now()
-        result = self.function(*args, **kwargs)
+        result = self.compute(args, kwargs, container)
         end = datetime.datetime.now()
         delta = (end - start).total_seconds() * 1000
         logger.debug(
@@ -127,54 +289,312 @@ class CacheMe(object):
         )
         return result
 
-    def set_result(self, key, result):
-        self.set_key(key, result)
-
-    def get_key(self, key):
-        key, field = split_key(key)
-        result = self.conn.hget(key, field)
+    def get_missing(self, args, kwargs, key, parts, container):
+        if self.in_progress(key):
+            for i in range(CACHEME.THUNDERING_HERD_RETRY_COUNT):
+                time.sleep(CACHEME.THUNDERING_HERD_RETRY_TIME/1000)
+                try:
+                    result = breaker.call(self.get_key, key, parts)
+                except CacheUnavailable:
+                    break
+                if result:
+                    return result
+
+        result = self.get_result_from_func(args, kwargs, key, container)
+        self.save_result(key, parts, result, container, progress=True)
+        return result
 
-        if result:
-            result = pickle.loads(result)
+    def single_flight(self, key, func, *args):
+        # concurrent misses of same key in this process wait for one call,
+        # before the redis progress set is even checked
+        with self.flights_lock:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = self.flights[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.flights_lock:
+                self.flights.pop(key, None)
         return result
 
-    def set_key(self, key, value):
-        self.keys = key
-        value = pickle.dumps(value)
-        key, field = split_key(key)
-        result = self.conn.hset(key, field, value)
-        if self.timeout:
-            self.conn.expire(key, self.timeout)
+    def run(self, args, kwargs):
+        # return result and rows read (None if not tracking)
+        if not self.track_reads:
+            return self.function(*args, **kwargs), None
+        with record_reads() as reads:
+            result = self.function(*args, **kwargs)
+        return result, list(reads)
+
+    def compute(self, args, kwargs, container):
+        future = None
+        if self.executor == 'process':
+            future = submit('process', call_function, self.name, args, kwargs)
+        elif self.executor:
+            future = submit('thread', self.run, args, kwargs)
+
+        result, reads = future.result() if future else self.run(args, kwargs)
+        if reads is not None:
+            container.cacheme_reads = reads
         return result
 
-    def push_key(self, key, value):
-        return self.conn.sadd(key, value)
+    def set_result(self, key, result, conn=None, parts=None):
+        self.set_key(key, result, conn, parts)
+
+    def save_result(self, key, parts, result, container, progress=False, deleted=False):
+        # value, progress and invalid keys are sent in one pipeline
+        self.set_local(key, result)
+        container.cacheme_result = result
+        pipe = self.conn.pipeline(transaction=False)
+        self.set_result(key, result, pipe, parts)
+        if progress:
+            pipe.srem(self.progress_key, key)
+        self.add_to_invalid_list(key, container, pipe)
+        try:
+            breaker.call(pipe.execute)
+        except CacheUnavailable:
+            # a dropped value is only a miss, but invalid keys must be kept, and
+            # an invalidated old value must not be served after recovery
+            if progress:
+                breaker.defer(self.remove_from_progress, key)
+            if deleted:
+                breaker.defer(self.add_to_deleted, key)
+            breaker.defer(self.add_to_invalid_list, key, container)
+
+    def get_degraded(self, args, kwargs, key, container):
+        # redis is unavailable, use local tier if any, or call function
+        if self.sampler:
+            result = self.sampler.local.get(key)
+            if result is not None:
+                return result
+        return self.compute(args, kwargs, container)
+
+    def in_progress(self, key):
+        try:
+            return breaker.call(self.add_to_progress, key) == 0
+        except CacheUnavailable:
+            return False
+
+    def set_local(self, key, result):
+        if self.sampler:
+            self.sampler.set_local(key, result)
+
+    def set_many(self, entries):
+        # entries are (key, parts, result, container), all written in one pipeline.
+        # delete marks are not touched, callers remove them before computing
+        if not entries:
+            return
+        pipe = self.conn.pipeline(transaction=False)
+        for key, parts, result, container in entries:
+            self.set_result(key, result, pipe, parts)
+            container.cacheme_result = result
+            self.add_to_invalid_list(key, container, pipe)
+        pipe.execute()
+
+    def get_key(self, key, parts=None):
+        key, field = parts or split_key(key)
+        result = self.conn.hget(key, field)
+
+        if not result:
+            return result
+        if result.startswith(COMPRESSED):
+            return pickle.loads(zlib.decompress(memoryview(result)[1:]))
+        if result.startswith(CHUNKED):
+            return self.get_chunks(key, field, int(result[1:]))
+        return pickle.loads(result)
+
+    def get_chunks(self, key, field, count):
+        pipe = self.conn.pipeline(transaction=False)
+        for i in range(count):
+            pipe.hget(key, chunk_field(field, i))
+        # reply is only referenced by reader, so chunks are freed while loading
+        reader = ChunkReader(pipe.execute())
+        if not reader.complete:
+            return None
+        try:
+            return pickle.load(reader)
+        except Exception:
+            # chunks overwritten by a concurrent write, treat as miss
+            logger.warning('[CACHEME CHUNK LOG] key: "%s>%s", broken chunks' % (key, field))
+            return None
+
+    def get_chunk_count(self, key, field):
+        # chunks of current value, only decorators with chunk policy write them
+        if not self.max_size or self.large_value != 'chunk':
+            return 0
+        try:
+            header = breaker.call(self.conn.hget, key, field)
+        except CacheUnavailable:
+            return 0
+        if header and header.startswith(CHUNKED):
+            return int(header[1:])
+        return 0
+
+    def encode(self, value):
+        # return (policy, values), values is empty if value is not cached
+        if not self.max_size or len(value) <= self.max_size:
+            return None, [value]
+        if self.large_value == 'compress':
+            value = COMPRESSED + zlib.compress(value)
+            if len(value) <= self.max_size:
+                return 'compressed', [value]
+        elif self.large_value == 'chunk':
+            size = self.max_size
+            return 'chunked', [value[i:i + size] for i in range(0, len(value), size)]
+        return 'skipped', []
+
+    def set_key(self, key, value, conn=None, parts=None):
+        pipe = conn or self.conn.pipeline(transaction=False)
+        policy, values = self.encode(pickle.dumps(value))
+
+        sizes = CACHEME.REDIS_CACHE_PREFIX + 'size:' + self.tag
+        pipe.hincrby(sizes, 'writes', 1)
+        pipe.hincrby(sizes, 'bytes_written', sum(len(v) for v in values))
+        if policy:
+            pipe.hincrby(sizes, policy, 1)
+            logger.debug('[CACHEME SIZE LOG] key: "%s", %s' % (key, policy))
+
+        tag_key = key
+        key, field = parts or split_key(key)
+        stale = self.get_chunk_count(key, field)
+        chunks = len(values) if policy == 'chunked' else 0
+
+        if values:
+            pipe.sadd(CACHEME.REDIS_CACHE_PREFIX + self.tag, tag_key)
+            if policy == 'chunked':
+                # chunks first, so header is never visible before them, one
+                # command per chunk, so other clients are served in between
+                for i, chunk in enumerate(values):
+                    pipe.hset(key, chunk_field(field, i), chunk)
+                pipe.hset(key, field, CHUNKED + str(chunks).encode())
+            else:
+                pipe.hset(key, field, values[0])
+            if self.timeout:
+                pipe.expire(key, self.timeout)
+        else:
+            # value is not cached, previous one must not be served instead
+            pipe.hdel(key, field)
+
+        # chunks past the header count are never read, removed after it is written
+        if stale > chunks:
+            pipe.hdel(key, *[chunk_field(field, i) for i in range(chunks, stale)])
+
+        if not conn:
+            pipe.execute()
 
-    def add_to_invalid_list(self, key, args, kwargs):
-        invalid_keys = self.invalid_keys
+    @property
+    def sizes(self):
+        sizes = self.conn.hgetall(CACHEME.REDIS_CACHE_PREFIX + 'size:' + self.tag)
+        return {k.decode(): int(v) for k, v in sizes.items()}
+
+    def push_key(self, key, value, conn=None):
+        conn = conn or self.conn
+        return conn.sadd(key, value)
+
+    def add_to_invalid_list(self, key, container, conn=None):
+        invalid_keys = []
+
+        if self.invalid_keys:
+            invalid_keys = flat_list(self.invalid_keys(container))
+        invalid_keys += getattr(container, 'cacheme_reads', [])
 
         if not invalid_keys:
             return
 
-        invalid_keys = invalid_keys(self.container)
-        invalid_keys = flat_list(invalid_keys)
+        # one pipeline for all invalid keys, tracked reads can be many
+        pipe = conn or self.conn.pipeline(transaction=False)
         for invalid_key in set(filter(lambda x: x is not None, invalid_keys)):
             invalid_key += ':invalid'
             invalid_key = self.key_prefix + invalid_key
-            self.push_key(invalid_key, key)
+            self.push_key(invalid_key, key, pipe)
+        if not conn:
+            pipe.execute()
 
     def link(self):
         models = self.invalid_models
         m2m_models = self.invalid_m2m_models
 
         for model in models:
-            post_save.connect(invalid_cache, model)
-            post_delete.connect(invalid_cache, model)
+            connect_signal(post_save, model)
+            connect_signal(post_delete, model)
 
         for model in m2m_models:
-            post_save.connect(invalid_cache, model)
-            post_delete.connect(invalid_cache, model)
-            m2m_changed.connect(invalid_cache, model)
+            connect_signal(post_save, model)
+            connect_signal(post_delete, model)
+            connect_signal(m2m_changed, model)
+
+        for model in self.refresh_on:
+            refreshers.setdefault(model, []).append(self)
+            connect_signal(post_save, model, refresh_cache)
+
+    def schedule_refresh(self, model, instance):
+        # kept per thread until transaction commits, so each key is
+        # recomputed once per transaction, from committed data
+        if not hasattr(pending, 'entries'):
+            pending.entries = {}
+        try:
+            for item in self.refresh_on[model](instance):
+                args, kwargs = to_call(item)
+                container = self.get_container(args, kwargs)
+                if self.should_skip(container):
+                    continue
+                key, parts = self.get_cache_key(container)
+                pending.entries[key] = (self, (key, parts, args, kwargs, container))
+        except Exception:
+            # runs in post_save receiver, so it must never break the save
+            logger.exception('[CACHEME REFRESH LOG] tag: "%s"' % self.tag)
+
+    def refresh(self, entries):
+        if self.refresh_mode != 'background':
+            self.rewrite(entries)
+            return
+        with self.refresh_lock:
+            entries = [entry for entry in entries if entry[0] not in self.refreshing]
+            self.refreshing.update(entry[0] for entry in entries)
+        if entries and not submit('thread', self.rewrite, entries, True):
+            # pool is full, run in this thread, its connection must stay open
+            with self.refresh_lock:
+                self.refreshing.difference_update(entry[0] for entry in entries)
+            self.rewrite(entries)
+
+    def rewrite(self, entries, background=False):
+        if background:
+            # saves from now on need another refresh
+            with self.refresh_lock:
+                self.refreshing.difference_update(entry[0] for entry in entries)
+            close_old_connections()
+        keys = [entry[0] for entry in entries]
+        try:
+            breaker.call(self.remove_from_deleted, *keys)
+            results = [
+                (key, parts, self.compute(args, kwargs, container), container)
+                for key, parts, args, kwargs, container in entries
+            ]
+            breaker.call(self.set_many, results)
+        except Exception as e:
+            # never break the save which triggered refresh, entries are only
+            # invalidated then, as without refresh
+            if not isinstance(e, CacheUnavailable):
+                logger.exception('[CACHEME REFRESH LOG] tag: "%s"' % self.tag)
+            breaker.guard(self.add_to_deleted, *keys)
+        finally:
+            if background:
+                close_old_connections()
+
+    def add_to_deleted(self, *keys):
+        self.conn.sadd(self.deleted, *keys)
+
+    def remove_from_deleted(self, *keys):
+        self.conn.srem(self.deleted, *keys)
 
     def remove_from_progress(self, key):
         self.conn.srem(self.progress_key, key)
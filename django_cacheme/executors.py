@@ -0,0 +1,53 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .utils import CACHEME
+
+
+pools = {}
+lock = threading.Lock()
+
+# set in pool workers, a worker blocked on its own pool can deadlock it
+local = threading.local()
+
+
+def get_pool(kind):
+    # one shared pool of each kind per process, created on first use,
+    # a forked child creates its own instead of using parent's workers
+    pid = os.getpid()
+    with lock:
+        entry = pools.get(kind)
+        if entry is None or entry[0] != pid:
+            if kind == 'process':
+                pool = ProcessPoolExecutor(CACHEME.COMPUTE_PROCESSES)
+            else:
+                pool = ThreadPoolExecutor(CACHEME.COMPUTE_THREADS)
+            entry = pools[kind] = (pid, pool, threading.BoundedSemaphore(CACHEME.COMPUTE_QUEUE_SIZE))
+    return entry[1], entry[2]
+
+
+def run_in_worker(func, *args):
+    local.worker = True
+    return func(*args)
+
+
+def submit(kind, func, *args):
+    # return a future, or None if queue is full or caller is a pool
+    # worker itself (nested cached calls), caller then runs func itself
+    if getattr(local, 'worker', False):
+        return None
+    pool, slots = get_pool(kind)
+    if not slots.acquire(blocking=False):
+        return None
+    try:
+        future = pool.submit(run_in_worker, func, *args)
+    except RuntimeError:
+        # broken or shut down pool, next call creates a new one
+        slots.release()
+        with lock:
+            pools.pop(kind, None)
+        return None
+    future.add_done_callback(lambda f: slots.release())
+    return future
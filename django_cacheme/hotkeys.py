@@ -0,0 +1,147 @@
+import time
+import random
+import threading
+
+from .breaker import CacheUnavailable
+from .utils import get_redis_conn, breaker, CACHEME
+
+
+# tag sets are stored at prefix + tag, so these names can not be a tag name
+hot_tags_key = CACHEME.REDIS_CACHE_PREFIX + 'hot-tags'
+
+
+def hot_key(tag):
+    return CACHEME.REDIS_CACHE_PREFIX + 'hot:' + tag
+
+
+class SpaceSaving(object):
+    # approximate top-k counter (space-saving), never holds more than size keys.
+    # when full, a new key replaces the smallest counter and inherits its count,
+    # so counts are over-estimated by at most that inherited value
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.size:
+            counts[key] = count
+        else:
+            smallest = min(counts, key=counts.get)
+            counts[key] = counts.pop(smallest) + count
+        return counts[key]
+
+    def top(self, n=None):
+        items = sorted(self.counts.items(), key=lambda x: x[1], reverse=True)
+        return items[:n] if n else items
+
+    def clear(self):
+        self.counts.clear()
+
+
+class LocalCache(object):
+    # in-process tier, entries expire after ttl seconds, that is the
+    # max staleness, because other processes can not invalidate it
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.data = {}
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            self.data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value):
+        if key not in self.data and len(self.data) >= self.size:
+            self.data.pop(next(iter(self.data)), None)
+        self.data[key] = (value, time.monotonic() + self.ttl)
+
+    def clear(self):
+        self.data.clear()
+
+
+class HotKeySampler(object):
+
+    def __init__(self, tag, rate=None, size=None, interval=None, local_threshold=None, local_ttl=None):
+        self.tag = tag
+        self.rate = rate if rate is not None else CACHEME.HOT_KEY_SAMPLE_RATE
+        self.size = size or CACHEME.HOT_KEY_TOP_K
+        self.interval = interval if interval is not None else CACHEME.HOT_KEY_FLUSH_INTERVAL
+        self.local_threshold = local_threshold if local_threshold is not None else CACHEME.HOT_KEY_LOCAL_THRESHOLD
+        self.local = LocalCache(
+            local_ttl if local_ttl is not None else CACHEME.HOT_KEY_LOCAL_TTL,
+            self.size
+        )
+        self.counter = SpaceSaving(self.size)
+        self.lock = threading.Lock()
+        self.flushed = time.monotonic()
+
+    def add(self, key):
+        if random.random() >= self.rate:
+            return
+        with self.lock:
+            self.counter.add(key)
+            if time.monotonic() - self.flushed < self.interval:
+                return
+            counts = self.counter.top()
+            self.counter.clear()
+            self.flushed = time.monotonic()
+        self.flush(counts)
+
+    def flush(self, counts):
+        if not counts:
+            return
+        # scale sampled counts back to real traffic, then merge into a
+        # redis sorted set trimmed to size, so memory stays bounded
+        key = hot_key(self.tag)
+        pipe = get_redis_conn().pipeline(transaction=False)
+        for member, count in counts:
+            pipe.zincrby(key, count / self.rate, member)
+        pipe.zremrangebyrank(key, 0, -self.size - 1)
+        pipe.sadd(hot_tags_key, self.tag)
+        try:
+            breaker.call(pipe.execute)
+        except CacheUnavailable:
+            # counts are samples, losing some is fine
+            pass
+
+    def is_hot(self, key):
+        return bool(self.local_threshold) and self.counter.counts.get(key, 0) >= self.local_threshold
+
+    def get_local(self, key):
+        if not self.local_threshold:
+            return None
+        return self.local.get(key)
+
+    def set_local(self, key, value):
+        if self.is_hot(key):
+            with self.lock:
+                self.local.set(key, value)
+
+
+def hot_keys(tag, limit=None):
+    conn = get_redis_conn()
+    result = conn.zrevrange(hot_key(tag), 0, (limit or 0) - 1, withscores=True)
+    return [(key.decode(), int(count)) for key, count in result]
+
+
+def hot_keys_report(tags=None, limit=None):
+    if not tags:
+        tags = sorted(tag.decode() for tag in get_redis_conn().smembers(hot_tags_key))
+    return [(tag, hot_keys(tag, limit)) for tag in tags]
+
+
+def reset_hot_keys(tag):
+    conn = get_redis_conn()
+    conn.unlink(hot_key(tag))
+    conn.srem(hot_tags_key, tag)
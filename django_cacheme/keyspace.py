@@ -0,0 +1,170 @@
+from redis.exceptions import ResponseError, WatchError
+
+from .cache_model import cacheme_tags, CHUNKED
+from .utils import get_redis_conn, split_key, chunk_field, CACHEME
+
+
+TTL_BUCKETS = ((60, '<1m'), (3600, '<1h'), (86400, '<1d'), (None, '>=1d'))
+
+# a chunked value stores only 'C<count>' in its field, never longer than this
+HEADER_SIZE = 21
+
+
+def ttl_label(ttl):
+    if ttl < 0:
+        return 'none'
+    for limit, label in TTL_BUCKETS:
+        if limit is None or ttl < limit:
+            return label
+
+
+def scan_members(conn, key, sample, batch):
+    # SSCAN a set in small batches, so redis is never blocked by a big set
+    cursor, count = 0, 0
+    while True:
+        cursor, members = conn.sscan(key, cursor, count=batch)
+        if sample:
+            members = members[:sample - count]
+        count += len(members)
+        if members:
+            yield members
+        if not cursor or (sample and count >= sample):
+            break
+
+
+def prune_dead(conn, key, dead):
+    # remove members still dead. Hashes are watched, if one is written
+    # meanwhile, nothing is removed, so a live entry never loses its member
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(*{split_key(member)[0] for member in dead})
+            check = conn.pipeline(transaction=False)
+            for member in dead:
+                check.hstrlen(*split_key(member))
+            dead = [member for member, size in zip(dead, check.execute()) if not size]
+            if not dead:
+                return 0
+            pipe.multi()
+            pipe.srem(key, *dead)
+            return pipe.execute()[0]
+        except WatchError:
+            return 0
+
+
+def chunk_bytes(conn, fields):
+    # bytes of chunks, for (main key, field) of values short enough to be chunk headers
+    pipe = conn.pipeline(transaction=False)
+    for main, field in fields:
+        pipe.hget(main, field)
+    headers = pipe.execute()
+
+    pipe = conn.pipeline(transaction=False)
+    for (main, field), header in zip(fields, headers):
+        if header and header.startswith(CHUNKED):
+            if type(field) == bytes:
+                field = field.decode()
+            for i in range(int(header[1:])):
+                pipe.hstrlen(main, chunk_field(field, i))
+    return sum(pipe.execute())
+
+
+def inspect_set(key, sample=None, batch=None, prune=False, memory=False):
+    # sample members (cache keys) of a set, member is dead if its hash field is gone
+    conn = get_redis_conn()
+    batch = batch or CACHEME.INSPECT_BATCH_SIZE
+    stats = {
+        'size': conn.scard(key), 'entries': 0, 'live': 0, 'dead': 0, 'pruned': 0,
+        'bytes': 0, 'memory': 0, 'ttl': dict.fromkeys(['none'] + [label for _, label in TTL_BUCKETS], 0),
+    }
+    hashes = set()
+
+    for members in scan_members(conn, key, sample, batch):
+        pipe = conn.pipeline(transaction=False)
+        for member in members:
+            main, field = split_key(member)
+            pipe.hstrlen(main, field)
+            pipe.ttl(main)
+        replies = pipe.execute()
+
+        dead = []
+        new_hashes = []
+        headers = []
+        for member, size, ttl in zip(members, replies[::2], replies[1::2]):
+            stats['entries'] += 1
+            if not size:
+                dead.append(member)
+                continue
+            stats['live'] += 1
+            stats['bytes'] += size
+            stats['ttl'][ttl_label(ttl)] += 1
+            main, field = split_key(member)
+            if size <= HEADER_SIZE:
+                headers.append((main, field))
+            if main not in hashes:
+                hashes.add(main)
+                new_hashes.append(main)
+        stats['dead'] += len(dead)
+
+        if headers:
+            stats['bytes'] += chunk_bytes(conn, headers)
+
+        if memory and new_hashes:
+            pipe = conn.pipeline(transaction=False)
+            for main in new_hashes:
+                pipe.memory_usage(main)
+            for usage in pipe.execute(raise_on_error=False):
+                if not isinstance(usage, ResponseError) and usage:
+                    stats['memory'] += usage
+
+        if prune and dead:
+            stats['pruned'] += prune_dead(conn, key, dead)
+
+    stats['dead_ratio'] = stats['dead'] / stats['entries'] if stats['entries'] else 0
+    return stats
+
+
+def inspect_tag(tag, sample=None, batch=None, prune=False):
+    stats = inspect_set(CACHEME.REDIS_CACHE_PREFIX + tag, sample, batch, prune, memory=True)
+    sizes = get_redis_conn().hgetall(CACHEME.REDIS_CACHE_PREFIX + 'size:' + tag)
+    stats['writes'] = {k.decode(): int(v) for k, v in sizes.items()}
+    return stats
+
+
+def inspect_invalid_sets(sample=None, batch=None, prune=False, max_sets=None):
+    # ':invalid' sets found with SCAN, sample applies to each set, and at most
+    # max_sets are inspected, tracked reads can create one set per row
+    conn = get_redis_conn()
+    batch = batch or CACHEME.INSPECT_BATCH_SIZE
+    max_sets = CACHEME.INSPECT_MAX_SETS if max_sets is None else max_sets
+    stats = {'sets': 0, 'size': 0, 'entries': 0, 'dead': 0, 'pruned': 0, 'truncated': False}
+    for key in conn.scan_iter(CACHEME.REDIS_CACHE_PREFIX + '*:invalid', count=batch):
+        if max_sets and stats['sets'] >= max_sets:
+            stats['truncated'] = True
+            break
+        result = inspect_set(key, sample, batch, prune)
+        stats['sets'] += 1
+        for name in ('size', 'entries', 'dead', 'pruned'):
+            stats[name] += result[name]
+    stats['dead_ratio'] = stats['dead'] / stats['entries'] if stats['entries'] else 0
+    return stats
+
+
+def all_tags():
+    # tags of this process, and tags written by any process (size accounting)
+    conn = get_redis_conn()
+    prefix = CACHEME.REDIS_CACHE_PREFIX + 'size:'
+    tags = set(cacheme_tags)
+    for key in conn.scan_iter(prefix + '*', count=CACHEME.INSPECT_BATCH_SIZE):
+        tags.add(key.decode()[len(prefix):])
+    return sorted(tags)
+
+
+def inspect_keyspace(tags=None, sample=None, batch=None, prune=False, sets=True, max_sets=None):
+    report = {
+        'tags': [(tag, inspect_tag(tag, sample, batch, prune)) for tag in tags or all_tags()],
+    }
+    if sets:
+        report['delete'] = inspect_set(CACHEME.REDIS_CACHE_PREFIX + 'delete', sample, batch, prune)
+        report['progress'] = get_redis_conn().scard(CACHEME.REDIS_CACHE_PREFIX + 'progress')
+        report['invalid'] = inspect_invalid_sets(sample, batch, prune, max_sets)
+    return report
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from django_cacheme.hotkeys import hot_keys_report, reset_hot_keys
+
+
+class Command(BaseCommand):
+    help = 'Show sampled hot keys for each tag'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tags', nargs='*', help='tags to report, default all sampled tags')
+        parser.add_argument('--limit', type=int, default=None)
+        parser.add_argument('--reset', action='store_true', help='clear counters after reporting')
+
+    def handle(self, *args, **options):
+        report = hot_keys_report(options['tags'], options['limit'])
+        if not report:
+            self.stdout.write('No hot keys sampled, is HOT_KEY_SAMPLE_RATE set?')
+        for tag, keys in report:
+            self.stdout.write(tag)
+            for key, count in keys:
+                self.stdout.write('  %s %s' % (count, key))
+            if options['reset']:
+                reset_hot_keys(tag)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from django_cacheme.keyspace import inspect_keyspace
+from django_cacheme.utils import CACHEME
+
+
+class Command(BaseCommand):
+    help = 'Show entries, bytes, dead members and ttl of each tag, and size of delete/invalid sets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tags', nargs='*', help='tags to inspect, default all known tags')
+        parser.add_argument(
+            '--sample', type=int, default=CACHEME.INSPECT_SAMPLE_SIZE,
+            help='members sampled per set, 0 means all'
+        )
+        parser.add_argument('--batch', type=int, default=None, help='members read in each SSCAN/pipeline')
+        parser.add_argument('--prune', action='store_true', help='remove dead members from sampled sets')
+        parser.add_argument('--no-sets', action='store_true', help='skip delete and invalid sets')
+        parser.add_argument(
+            '--max-sets', type=int, default=CACHEME.INSPECT_MAX_SETS,
+            help='max invalid sets inspected, 0 means all'
+        )
+
+    def handle(self, *args, **options):
+        report = inspect_keyspace(
+            options['tags'], options['sample'], options['batch'], options['prune'], not options['no_sets'],
+            options['max_sets']
+        )
+        for tag, stats in report['tags']:
+            self.stdout.write(tag)
+            self.stdout.write(
+                '  keys: %(size)s, sampled: %(entries)s, dead: %(dead)s (%(dead_ratio).0f%%), pruned: %(pruned)s'
+                % dict(stats, dead_ratio=stats['dead_ratio'] * 100)
+            )
+            self.stdout.write('  value bytes: %(bytes)s, memory: %(memory)s' % stats)
+            self.stdout.write('  ttl: %s' % ', '.join('%s %s' % item for item in stats['ttl'].items()))
+            if stats['writes']:
+                self.stdout.write('  writes: %s' % ', '.join('%s %s' % item for item in sorted(stats['writes'].items())))
+
+        if 'delete' in report:
+            stats = report['delete']
+            self.stdout.write(
+                'delete set: %s, sampled: %s, dead: %s, pruned: %s'
+                % (stats['size'], stats['entries'], stats['dead'], stats['pruned'])
+            )
+            self.stdout.write('progress set: %s' % report['progress'])
+            stats = report['invalid']
+            self.stdout.write(
+                'invalid sets: %s%s, members: %s, sampled: %s, dead: %s, pruned: %s'
+                % (stats['sets'], ' (truncated)' if stats['truncated'] else '', stats['size'], stats['entries'],
+                   stats['dead'], stats['pruned'])
+            )
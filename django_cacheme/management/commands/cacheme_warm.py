@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from django_cacheme.cache_model import cacheme_tags
+from django_cacheme.warm import warm
+
+
+class Command(BaseCommand):
+    help = 'Precompute and store cache entries of a tag'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tag')
+        parser.add_argument(
+            'source',
+            help='dotted path to a callable returning the args for each entry, '
+                 'importing it should also import the cached function'
+        )
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--rate', type=float, default=None, help='max calls per second')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--processes', action='store_true', help='use a process pool instead of threads')
+
+    def handle(self, *args, **options):
+        try:
+            source = import_string(options['source'])
+        except ImportError as e:
+            raise CommandError(e)
+
+        tag = options['tag']
+        if tag not in cacheme_tags:
+            raise CommandError('Unknown tag "%s", available: %s' % (tag, ', '.join(sorted(cacheme_tags))))
+
+        count = warm(
+            tag, source(),
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            batch_size=options['batch_size'],
+            processes=options['processes']
+        )
+        self.stdout.write('Warmed %s entries for tag "%s"' % (count, tag))
@@ -0,0 +1,67 @@
+import threading
+
+from django.db.models.signals import post_init, post_save, post_delete
+
+from .utils import invalid_keys_in_set, dependents_key, breaker, _dependents, CACHEME
+
+
+local = threading.local()
+
+
+def row_key(instance):
+    return '%s:%s' % (instance._meta.label_lower, instance.pk)
+
+
+def table_key(model):
+    return model._meta.label_lower
+
+
+class record_reads(object):
+    # collect keys of model rows loaded from database in this thread,
+    # nested recordings all see the rows, so outer function depends on them too
+
+    def __enter__(self):
+        if not hasattr(local, 'stack'):
+            local.stack = []
+        self.reads = set()
+        local.stack.append(self.reads)
+        return self.reads
+
+    def __exit__(self, *exc):
+        local.stack.pop()
+
+
+def record_instance(sender, instance, **kwargs):
+    stack = getattr(local, 'stack', None)
+    if not stack or instance.pk is None:
+        return
+    keys = (row_key(instance), table_key(sender))
+    for reads in stack:
+        reads.update(keys)
+
+
+def record_entry(key):
+    # a nested cached call, hit or miss, outer entries depend on it, because
+    # on a hit its rows are not loaded
+    stack = getattr(local, 'stack', None)
+    if not stack:
+        return
+    key = dependents_key(key)
+    for reads in stack:
+        reads.add(key)
+
+
+def invalid_reads(sender, instance, created=False, **kwargs):
+    if not CACHEME.ENABLE_CACHE:
+        return
+    breaker.guard(invalid_keys_in_set, row_key(instance))
+    # a new row may match queries which read this table before
+    if created:
+        breaker.guard(invalid_keys_in_set, table_key(sender))
+
+
+def enable_tracking():
+    _dependents['enabled'] = True
+    post_init.connect(record_instance, dispatch_uid='cacheme_record_instance')
+    post_save.connect(invalid_reads, dispatch_uid='cacheme_invalid_reads')
+    post_delete.connect(invalid_reads, dispatch_uid='cacheme_invalid_reads')
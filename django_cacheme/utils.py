@@ -1,17 +1,70 @@
+import os
+import re
+
+from string import Formatter
 from django.conf import settings
 from django_redis import get_redis_connection
 
+from .breaker import CircuitBreaker
+
 
 CACHEME = {
     'REDIS_CACHE_PREFIX': 'CM',  # key prefix for cache
     'REDIS_CACHE_SCAN_COUNT': 10,
     'THUNDERING_HERD_RETRY_COUNT': 5,
-    'THUNDERING_HERD_RETRY_TIME': 20
+    'THUNDERING_HERD_RETRY_TIME': 20,
+    'WARM_BATCH_SIZE': 100,
+    'HOT_KEY_SAMPLE_RATE': 0,  # 0 disables hot key sampling
+    'HOT_KEY_TOP_K': 20,
+    'HOT_KEY_FLUSH_INTERVAL': 10,
+    'HOT_KEY_LOCAL_THRESHOLD': 0,  # 0 disables local tier
+    'HOT_KEY_LOCAL_TTL': 2,
+    'MAX_VALUE_SIZE': 0,  # bytes, 0 means no limit
+    'LARGE_VALUE_POLICY': 'skip',  # skip, compress or chunk
+    'BREAKER_ERROR_THRESHOLD': 5,  # 0 disables circuit breaker
+    'BREAKER_LATENCY': 0,  # ms, slower calls count as errors, 0 disables
+    'BREAKER_RESET_TIMEOUT': 5,
+    'BREAKER_QUEUE_SIZE': 1000,
+    'COMPUTE_THREADS': 4,
+    'COMPUTE_PROCESSES': None,  # None means cpu count
+    'COMPUTE_QUEUE_SIZE': 100,
+    'INSPECT_SAMPLE_SIZE': 1000,
+    'INSPECT_BATCH_SIZE': 100,
+    'INSPECT_MAX_SETS': 100,  # 0 means all
 }
 
 CACHEME.update(getattr(settings, 'CACHEME', {}))
 CACHEME = type('CACHEME', (), CACHEME)
 
+_connection = {}
+
+# set once any decorator tracks reads, invalidation then also follows
+# entries which called an invalidated entry (nested cached calls)
+_dependents = {'enabled': False}
+
+# invalidations failed while redis is unavailable are replayed on recovery,
+# if too many are queued, whole cache is flushed instead
+breaker = CircuitBreaker(
+    CACHEME.BREAKER_ERROR_THRESHOLD,
+    latency=CACHEME.BREAKER_LATENCY,
+    reset_timeout=CACHEME.BREAKER_RESET_TIMEOUT,
+    queue_size=CACHEME.BREAKER_QUEUE_SIZE,
+    on_overflow=lambda: invalid_pattern(CACHEME.REDIS_CACHE_PREFIX + '*')
+)
+
+
+def get_redis_conn():
+    # resolve connection on first use, and cache it per process. A forked
+    # child drops the sockets inherited from parent and resolves its own
+    pid = os.getpid()
+    if _connection.get('pid') != pid:
+        conn = get_redis_connection(CACHEME.REDIS_CACHE_ALIAS)
+        if 'pid' in _connection:
+            conn.connection_pool.reset()
+        _connection['conn'] = conn
+        _connection['pid'] = pid
+    return _connection['conn']
+
 
 def split_key(string):
     lg = b'>' if type(string) == bytes else '>'
@@ -20,13 +73,131 @@ def split_key(string):
     return [string, 'base']
 
 
+def split_template(template):
+    # split at '>' outside of replacement fields, so a format spec such as
+    # '{id:>5}' is kept, return (main, '>' or '', field)
+    parts = [[]]
+    for literal, name, spec, conversion in Formatter().parse(template):
+        literal = literal.replace('{', '{{').replace('}', '}}')
+        for i, text in enumerate(literal.split('>')):
+            if i:
+                parts.append([])
+            parts[-1].append(text)
+        if name is not None:
+            parts[-1].append(
+                '{' + name + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}'
+            )
+    if len(parts) > 2:
+        raise ValueError('Key template "%s" contains more than one ">"' % template)
+    parts = [''.join(part) for part in parts]
+    if len(parts) == 1:
+        return parts[0], '', ''
+    return parts[0], '>', parts[1]
+
+
+def template_fields(template):
+    # argument names used by a key template, attributes and items excluded
+    names = set()
+    for _, name, spec, _ in Formatter().parse(template):
+        if name is not None:
+            names.add(re.split(r'[.\[]', name, maxsplit=1)[0])
+        if spec:
+            names |= template_fields(spec)
+    return names
+
+
+def compile_key(template, prefix=''):
+    # compile a key template such as 'Book:{obj.id}>owner' once, return a
+    # function building (key, (main key, field)) from container arguments,
+    # so no split is needed per call
+    main, lg, field = split_template(template)
+    main_format = (prefix.replace('{', '{{').replace('}', '}}') + main).format_map
+
+    if not lg:
+        def build(arguments):
+            key = main_format(arguments)
+            return key, (key, 'base')
+        return build
+
+    if all(name is None for _, name, _, _ in Formatter().parse(field)):
+        field = field.format_map({})
+        suffix = '>' + field
+
+        def build(arguments):
+            key = main_format(arguments)
+            return key + suffix, (key, field)
+        return build
+
+    field_format = field.format_map
+
+    def build(arguments):
+        key = main_format(arguments)
+        value = field_format(arguments)
+        return key + '>' + value, (key, value)
+    return build
+
+
+def chunk_field(field, index):
+    return '%s:chunk:%s' % (field, index)
+
+
+class ChunkReader(object):
+    # file like object over a list of chunks for pickle.load, chunks are
+    # released once consumed, so raw bytes and result are not both held.
+    # list is consumed in place, caller should not keep another reference
+
+    def __init__(self, chunks):
+        self.complete = all(chunks)
+        chunks.reverse()
+        self.chunks = chunks
+        self.buffer = bytearray()
+
+    def fill(self, size):
+        while self.chunks and (size < 0 or len(self.buffer) < size):
+            self.buffer += self.chunks.pop()
+
+    def read(self, size=-1):
+        self.fill(size)
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self):
+        while self.chunks and b'\n' not in self.buffer:
+            self.buffer += self.chunks.pop()
+        index = self.buffer.find(b'\n')
+        return self.read(index + 1 if index >= 0 else -1)
+
+
+def dependents_key(key):
+    # invalid key of a cache entry, outer entries which called it are in its set
+    if type(key) == bytes:
+        key = key.decode()
+    return 'entry:' + key[len(CACHEME.REDIS_CACHE_PREFIX):]
+
+
+def mark_deleted(keys, conn=None):
+    if not conn:
+        conn = get_redis_conn()
+    seen = set()
+    while keys:
+        conn.sadd(CACHEME.REDIS_CACHE_PREFIX + 'delete', *keys)
+        if not _dependents['enabled']:
+            return
+        seen.update(keys)
+        sets = [CACHEME.REDIS_CACHE_PREFIX + dependents_key(key) + ':invalid' for key in keys]
+        keys = conn.sunion(sets) - seen
+
+
 def invalid_keys_in_set(key, conn=None):
     if not conn:
-        conn = get_redis_connection(CACHEME.REDIS_CACHE_ALIAS)
+        conn = get_redis_conn()
     key = CACHEME.REDIS_CACHE_PREFIX + key + ':invalid'
     invalid_keys = conn.smembers(key)
     if invalid_keys:
-        conn.sadd(CACHEME.REDIS_CACHE_PREFIX + 'delete', *invalid_keys)
+        mark_deleted(invalid_keys, conn)
 
 
 def invalid_cache(sender, instance, created=False, **kwargs):
@@ -40,14 +211,12 @@ def invalid_cache(sender, instance, created=False, **kwargs):
     if kwargs.get('action', False):
         m2m = True
 
-    conn = get_redis_connection(CACHEME.REDIS_CACHE_ALIAS)
-
     if not m2m and instance.cache_key:
         keys = instance.cache_key
         if type(instance.cache_key) == str:
             keys = [keys]
         for key in keys:
-            invalid_keys_in_set(key, conn)
+            breaker.guard(invalid_keys_in_set, key)
 
     if m2m:
         name = instance.__class__.__name__
@@ -56,7 +225,17 @@ def invalid_cache(sender, instance, created=False, **kwargs):
         from_invalid_key = list(m2m_cache_keys.values())[0]([instance.id])
         all = from_invalid_key + to_invalid_keys
         for key in all:
-            invalid_keys_in_set(key, conn)
+            breaker.guard(invalid_keys_in_set, key)
+
+
+def to_call(item):
+    # each item is a tuple of positional args, a dict of keyword args,
+    # or a single positional arg
+    if isinstance(item, dict):
+        return (), item
+    if isinstance(item, (list, tuple)):
+        return tuple(item), {}
+    return (item,), {}
 
 
 def flat_list(li):
@@ -83,7 +262,7 @@ def chunk_iter(iterator, size, stop):
 
 
 def invalid_pattern(pattern):
-    conn = get_redis_connection(CACHEME.REDIS_CACHE_ALIAS)
+    conn = get_redis_conn()
     chunks = chunk_iter(conn.scan_iter(pattern, count=CACHEME.REDIS_CACHE_SCAN_COUNT), 500, None)
     for keys in chunks:
         if keys:
@@ -0,0 +1,101 @@
+import time
+import logging
+
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from django.db import connections
+
+from .cache_model import cacheme_tags, call_function
+from .utils import to_call, CACHEME
+
+
+logger = logging.getLogger('cacheme')
+
+
+def warm(tag, iterable, concurrency=1, rate=None, batch_size=None, processes=False):
+    """
+    Recompute and store entries of tag, one entry for each item in iterable.
+    Results are computed in a pool of concurrency threads (or processes),
+    at most rate calls per second, and written in pipelined batches.
+    Return the number of entries written.
+    """
+    instance = cacheme_tags[tag]
+    batch_size = batch_size or CACHEME.WARM_BATCH_SIZE
+
+    pool = None
+    if concurrency > 1:
+        if processes:
+            # forked workers must not share database sockets with parent
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=concurrency)
+        else:
+            pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    count = 0
+    index = 0
+    start = time.monotonic()
+
+    def collect(key, parts, result, container):
+        if pool:
+            result = result.result()
+            if processes:
+                result, reads = result
+                if reads is not None:
+                    container.cacheme_reads = reads
+        return key, parts, result, container
+
+    try:
+        items = iter(iterable)
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                break
+
+            entries = []
+            for item in batch:
+                args, kwargs = to_call(item)
+                container = instance.get_container(args, kwargs)
+                if instance.should_skip(container):
+                    continue
+                key, parts = instance.get_cache_key(container)
+                entries.append((key, parts, args, kwargs, container))
+            if not entries:
+                continue
+
+            # delete marks are removed before computing, an invalidation
+            # arriving meanwhile stays and the entry is recomputed on read
+            keys = [entry[0] for entry in entries]
+            instance.remove_from_deleted(*keys)
+
+            try:
+                results = []
+                for key, parts, args, kwargs, container in entries:
+                    if rate:
+                        delay = start + index / rate - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    index += 1
+
+                    if pool and processes:
+                        result = pool.submit(call_function, instance.name, args, kwargs)
+                    elif pool:
+                        result = pool.submit(instance.compute, args, kwargs, container)
+                    else:
+                        result = instance.compute(args, kwargs, container)
+                    results.append((key, parts, result, container))
+
+                # at most batch_size calls are in flight, so a huge iterable is not submitted at once
+                instance.set_many([collect(*entry) for entry in results])
+            except BaseException:
+                # old values of this batch may be stored, keep them invalid
+                instance.add_to_deleted(*keys)
+                raise
+            count += len(results)
+    finally:
+        if pool:
+            pool.shutdown()
+
+    logger.debug(
+        '[CACHEME WARM LOG] tag: "%s", count: %s, time: %s s' % (tag, count, time.monotonic() - start)
+    )
+    return count
@@ -12,7 +12,13 @@ setup(
     version='v0.0.9',
     packages=[
         "django_cacheme",
+        "django_cacheme.migrations",
+        "django_cacheme.management",
+        "django_cacheme.management.commands",
     ],
+    package_data={
+        "django_cacheme": ["templates/admin/django_cacheme/*.html"],
+    },
     description=description,
     python_requires=">=3.5",
     install_requires=[
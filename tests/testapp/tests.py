@@ -1,16 +1,33 @@
+import os
 import pickle
 import time
+import threading
 import datetime
 
 import redis
-from unittest.mock import MagicMock
+from contextlib import contextmanager
+from concurrent.futures import Future
+from unittest.mock import MagicMock, patch
+from io import StringIO
 from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command, CommandError
+from django.db.models.signals import post_save
 from django.test import TestCase
 from django_redis import get_redis_connection
 
 from .models import TestUser, Book
-from django_cacheme import cacheme, cacheme_tags
+from django_cacheme import cacheme, cacheme_tags, warm
 from django_cacheme.models import Invalidation
+from django_cacheme import utils
+from django_cacheme.cache_model import linked_signals, call_function
+from django_cacheme.utils import invalid_cache
+from django_cacheme.hotkeys import SpaceSaving, HotKeySampler, hot_keys
+from django_cacheme.breaker import CircuitBreaker, CacheUnavailable
+from django_cacheme.utils import breaker
+from django_cacheme import executors
+from django_cacheme.executors import get_pool, submit
+from django_cacheme.keyspace import inspect_keyspace, inspect_tag
 
 from django.contrib.auth.models import User
 from django.contrib.admin.sites import AdminSite
@@ -24,6 +41,55 @@ hit = MagicMock()
 miss = MagicMock()
 
 
+@cacheme(
+    key=lambda c: 'Warm:%s' % c.n,
+    invalid_keys=lambda c: ['Double:%s' % c.cacheme_result],
+    tag='warm'
+)
+def cache_warm(n):
+    return n * 2
+
+
+def warm_source():
+    return range(5)
+
+
+@cacheme(
+    key=lambda c: 'WarmRace:%s' % c.n,
+    tag='warm_race'
+)
+def cache_warm_race(n):
+    # invalidated while computing
+    utils.get_redis_conn().sadd('TEST:delete', 'TEST:WarmRace:%s' % n)
+    return n
+
+
+@cacheme(
+    key='Process:{n}',
+    executor='process'
+)
+def cache_process(n):
+    return n, os.getpid()
+
+
+@cacheme(key='ProcessInner:{n}', executor='process')
+def cache_process_inner(n):
+    return n
+
+
+@cacheme(key='ProcessOuter:{n}', executor='process')
+def cache_process_outer(n):
+    return cache_process_inner(n) + 1
+
+
+@cacheme(
+    key=lambda c: 'Hot:%s' % c.n,
+    tag='hot'
+)
+def cache_hot(n):
+    return {'n': n, 'time': time.monotonic()}
+
+
 class BaseTestCase(TestCase):
     def tearDown(self):
         connection = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
@@ -331,3 +397,714 @@ class AdminTestCase(BaseTestCase):
         self.assertTrue(form.is_valid())
         admin.save_model(request, obj2, form, False)
         self.assertEqual(Invalidation.objects.get(id=999).tags, 'test')
+
+
+class ConnectionTestCase(BaseTestCase):
+
+    def tearDown(self):
+        utils._connection.clear()
+        super().tearDown()
+
+    def test_lazy_connection(self):
+        utils._connection.clear()
+        with patch('django_cacheme.utils.get_redis_connection') as get_conn:
+            decorator = cacheme(key=lambda c: 'lazy', invalid_models=[TestUser])
+            decorator(lambda: 'lazy')
+            get_conn.assert_not_called()
+
+            decorator.conn
+            decorator.conn
+            self.assertEqual(get_conn.call_count, 1)
+
+    def test_connection_after_fork(self):
+        utils._connection.clear()
+        with patch('django_cacheme.utils.get_redis_connection') as get_conn:
+            conn = utils.get_redis_conn()
+            conn.connection_pool.reset.assert_not_called()
+
+            utils._connection['pid'] = -1
+            self.assertEqual(utils.get_redis_conn(), conn)
+            self.assertEqual(get_conn.call_count, 2)
+            conn.connection_pool.reset.assert_called_once_with()
+
+    def test_link_once(self):
+        cacheme(key=lambda c: 'link1', invalid_models=[TestUser])
+        with patch.object(post_save, 'connect') as connect:
+            cacheme(key=lambda c: 'link2', invalid_models=[TestUser])
+            connect.assert_not_called()
+        self.assertIn((post_save, TestUser, invalid_cache), linked_signals)
+
+
+class WarmTestCase(BaseTestCase):
+
+    def test_warm(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        conn.sadd('TEST:delete', 'TEST:Warm:1')
+
+        count = warm('warm', [1, (2,), {'n': 3}], concurrency=2, batch_size=2)
+        self.assertEqual(count, 3)
+        self.assertEqual(pickle.loads(conn.hget('TEST:Warm:3', 'base')), 6)
+        self.assertEqual(cacheme_tags['warm'].keys, {b'TEST:Warm:1', b'TEST:Warm:2', b'TEST:Warm:3'})
+        self.assertEqual(conn.smembers('TEST:Double:4:invalid'), {b'TEST:Warm:2'})
+        self.assertFalse(conn.sismember('TEST:delete', 'TEST:Warm:1'))
+
+    def test_warm_rate(self):
+        start = time.monotonic()
+        warm('warm', range(6), rate=100)
+        self.assertTrue(time.monotonic() - start >= 0.05)
+
+    def test_warm_processes(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.assertEqual(warm('warm', [1, 2], processes=True), 2)
+        self.assertEqual(pickle.loads(conn.hget('TEST:Warm:2', 'base')), 4)
+
+    def test_warm_invalidated_meanwhile(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        warm('warm_race', [1])
+        self.assertTrue(conn.sismember('TEST:delete', 'TEST:WarmRace:1'))
+
+    def test_warm_error(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        with patch.object(cacheme_tags['warm'], 'set_many', side_effect=ValueError()):
+            with self.assertRaises(ValueError):
+                warm('warm', [1])
+        self.assertTrue(conn.sismember('TEST:delete', 'TEST:Warm:1'))
+
+    def test_warm_command(self):
+        out = StringIO()
+        call_command('cacheme_warm', 'warm', 'tests.testapp.tests.warm_source', '--concurrency=2', stdout=out)
+        self.assertIn('Warmed 5 entries', out.getvalue())
+        self.assertEqual(len(cacheme_tags['warm'].keys), 5)
+
+        with self.assertRaises(CommandError):
+            call_command('cacheme_warm', 'missing', 'tests.testapp.tests.warm_source')
+
+
+class HotKeyTestCase(BaseTestCase):
+
+    def tearDown(self):
+        cacheme_tags['hot'].sampler = None
+        super().tearDown()
+
+    def test_space_saving(self):
+        counter = SpaceSaving(2)
+        for key in ['a', 'a', 'a', 'b', 'c', 'a']:
+            counter.add(key)
+        self.assertEqual(len(counter.counts), 2)
+        self.assertEqual(counter.top(1), [('a', 4)])
+        self.assertEqual(counter.counts['c'], 2)
+
+    def test_sampler_flush(self):
+        cacheme_tags['hot'].sampler = HotKeySampler('hot', rate=1, size=2, interval=0)
+        for n in [1, 1, 1, 2, 2, 3]:
+            cache_hot(n)
+        self.assertEqual(hot_keys('hot'), [('TEST:Hot:1', 3), ('TEST:Hot:2', 2)])
+        self.assertEqual(hot_keys('hot', limit=1), [('TEST:Hot:1', 3)])
+        self.assertEqual(cacheme_tags['hot'].keys, {b'TEST:Hot:1', b'TEST:Hot:2', b'TEST:Hot:3'})
+
+        out = StringIO()
+        call_command('cacheme_hotkeys', '--reset', stdout=out)
+        self.assertIn('3 TEST:Hot:1', out.getvalue())
+        self.assertEqual(hot_keys('hot'), [])
+
+    def test_local_tier(self):
+        sampler = HotKeySampler('hot', rate=1, interval=100, local_threshold=2, local_ttl=100)
+        cacheme_tags['hot'].sampler = sampler
+        first = cache_hot(1)
+        self.assertEqual(sampler.local.data, {})
+        self.assertEqual(cache_hot(1), first)
+        self.assertIn('TEST:Hot:1', sampler.local.data)
+
+        # served from local tier, redis is not touched
+        with patch('django_cacheme.cache_model.get_redis_conn') as conn:
+            self.assertEqual(cache_hot(1), first)
+            conn.assert_not_called()
+
+    def test_admin_view(self):
+        HotKeySampler('hot', rate=1, interval=0).add('TEST:Hot:9')
+        admin = InvalidationAdmin(model=Invalidation, admin_site=AdminSite())
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='test_admin', is_staff=True, is_superuser=True)
+        response = admin.hot_keys_view(request)
+        self.assertEqual(response.context_data['report'], [('hot', [('TEST:Hot:9', 1)])])
+
+        request.user = User.objects.create(username='test_staff', is_staff=True)
+        with self.assertRaises(PermissionDenied):
+            admin.hot_keys_view(request)
+
+
+class LargeValueTestCase(BaseTestCase):
+
+    @cacheme(
+        key=lambda c: 'Large:chunk>%s' % c.n,
+        max_size=64,
+        large_value='chunk'
+    )
+    def cache_chunk(self, n):
+        return list(range(n))
+
+    @cacheme(
+        key=lambda c: 'Large:compress',
+        max_size=64,
+        large_value='compress'
+    )
+    def cache_compress(self, n):
+        return 'a' * n
+
+    @cacheme(
+        key=lambda c: 'Large:skip',
+        max_size=64
+    )
+    def cache_skip(self, n):
+        return list(range(n))
+
+    def test_chunk(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.assertEqual(self.cache_chunk(100), list(range(100)))
+        header = conn.hget('TEST:Large:chunk', '100')
+        self.assertTrue(header.startswith(b'C'))
+        count = int(header[1:])
+        self.assertTrue(count > 1)
+        self.assertTrue(all(len(conn.hget('TEST:Large:chunk', '100:chunk:%s' % i)) <= 64 for i in range(count)))
+        self.assertEqual(cacheme_tags['cache_chunk'].get_key('TEST:Large:chunk>100'), list(range(100)))
+
+        # small values are stored as is
+        self.assertEqual(self.cache_chunk(2), [0, 1])
+        self.assertEqual(pickle.loads(conn.hget('TEST:Large:chunk', '2')), [0, 1])
+
+        # missing chunk is a miss
+        conn.hdel('TEST:Large:chunk', '100:chunk:0')
+        self.assertEqual(cacheme_tags['cache_chunk'].get_key('TEST:Large:chunk>100'), None)
+
+    def test_inspect_chunked(self):
+        self.cache_chunk(1000)
+        size = len(pickle.dumps(list(range(1000))))
+        header = len('C%s' % -(-size // 64))
+        self.assertEqual(inspect_tag('cache_chunk')['bytes'], size + header)
+
+    def test_compress(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.assertEqual(self.cache_compress(1000), 'a' * 1000)
+        self.assertTrue(conn.hget('TEST:Large:compress', 'base').startswith(b'Z'))
+        self.assertEqual(self.cache_compress(1), 'a' * 1000)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            cacheme(key=lambda c: 'Large:typo', large_value='chunks')
+
+    def test_skip_and_sizes(self):
+        self.assertEqual(self.cache_skip(100), list(range(100)))
+        self.assertEqual(self.cache_skip(101), list(range(101)))
+        self.assertEqual(cacheme_tags['cache_skip'].keys, set())
+
+        sizes = cacheme_tags['cache_skip'].sizes
+        self.assertEqual(sizes['writes'], 2)
+        self.assertEqual(sizes['skipped'], 2)
+        self.assertEqual(sizes['bytes_written'], 0)
+
+    def test_skip_removes_previous(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.assertEqual(self.cache_skip(3), [0, 1, 2])
+        conn.sadd('TEST:delete', 'TEST:Large:skip')
+        self.assertEqual(self.cache_skip(300), list(range(300)))
+        self.assertEqual(self.cache_skip(1), list(range(1)))
+
+    def test_chunks_removed(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.cache_chunk(100)
+        count = int(conn.hget('TEST:Large:chunk', '100')[1:])
+        instance = cacheme_tags['cache_chunk']
+        instance.set_key('TEST:Large:chunk>100', list(range(50)))
+        smaller = int(conn.hget('TEST:Large:chunk', '100')[1:])
+        self.assertTrue(smaller < count)
+        self.assertEqual(conn.hlen('TEST:Large:chunk'), smaller + 1)
+        self.assertEqual(instance.get_key('TEST:Large:chunk>100'), list(range(50)))
+
+        instance.set_key('TEST:Large:chunk>100', [1])
+        self.assertEqual(conn.hkeys('TEST:Large:chunk'), [b'100'])
+        self.assertEqual(instance.get_key('TEST:Large:chunk>100'), [1])
+
+
+class TrackReadsTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    @cacheme(
+        key=lambda c: 'Track:%s' % c.name,
+        track_reads=True
+    )
+    def cache_tracked(self, name):
+        self.calls += 1
+        return [b.id for b in Book.objects.filter(name=name)]
+
+    @cacheme(
+        key=lambda c: 'TrackOuter:%s' % c.name,
+        track_reads=True
+    )
+    def cache_tracked_outer(self, name):
+        return [self.cache_tracked(name), 'outer']
+
+    def test_nested_hit(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        book1 = Book.objects.create(name='a')
+        self.assertEqual(self.cache_tracked('a'), [book1.id])
+        # inner hits cache, so outer loads no rows but depends on inner entry
+        self.assertEqual(self.cache_tracked_outer('a'), [[book1.id], 'outer'])
+        self.assertEqual(conn.smembers('TEST:entry:Track:a:invalid'), {b'TEST:TrackOuter:a'})
+
+        book1.name = 'b'
+        book1.save()
+        self.assertEqual(self.cache_tracked_outer('a'), [[], 'outer'])
+        self.assertEqual(self.calls, 2)
+
+    def test_track_reads(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        book1 = Book.objects.create(name='a')
+        book2 = Book.objects.create(name='b')
+
+        self.assertEqual(self.cache_tracked('a'), [book1.id])
+        self.assertEqual(
+            conn.smembers('TEST:testapp.book:%s:invalid' % book1.id), {b'TEST:Track:a'}
+        )
+        self.assertEqual(conn.smembers('TEST:testapp.book:invalid'), {b'TEST:Track:a'})
+
+        # row not read, still cached
+        book2.save()
+        self.assertEqual(self.cache_tracked('a'), [book1.id])
+        self.assertEqual(self.calls, 1)
+
+        # row read, invalid
+        book1.save()
+        self.assertEqual(self.cache_tracked('a'), [book1.id])
+        self.assertEqual(self.calls, 2)
+
+        # new row, invalid
+        book3 = Book.objects.create(name='a')
+        self.assertEqual(self.cache_tracked('a'), [book1.id, book3.id])
+        self.assertEqual(self.calls, 3)
+
+
+class KeyTemplateTestCase(BaseTestCase):
+
+    @cacheme(
+        key='Book:{book.id}>owner:{self.check}',
+        invalid_keys=lambda c: [c.book.cache_key],
+        invalid_models=[Book]
+    )
+    def cache_template(self, book):
+        return {'book': book.id, 'check': self.check}
+
+    @cacheme(key='Template:{a}:{{raw}}')
+    def cache_template_base(self, a):
+        return a
+
+    def test_template(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        book = Book.objects.create(name='b')
+        self.check = 1
+        self.assertEqual(self.cache_template(book), {'book': book.id, 'check': 1})
+        result = conn.hget('TEST:Book:%s' % book.id, 'owner:1')
+        self.assertEqual(pickle.loads(result), {'book': book.id, 'check': 1})
+        self.assertEqual(cacheme_tags['cache_template'].keys, {('TEST:Book:%s>owner:1' % book.id).encode()})
+
+        book.save()
+        self.assertTrue(conn.sismember('TEST:delete', 'TEST:Book:%s>owner:1' % book.id))
+
+        self.assertEqual(self.cache_template_base(5), 5)
+        self.assertEqual(pickle.loads(conn.hget('TEST:Template:5:{raw}', 'base')), 5)
+        self.assertEqual(cacheme_tags['cache_template_base'].get_key('TEST:Template:5:{raw}'), 5)
+
+    def test_template_invalid(self):
+        with self.assertRaises(ValueError):
+            cacheme(key='a>b>c')
+        with self.assertRaises(ValueError):
+            cacheme(key='Book:{boook.id}')(lambda book: book)
+
+    def test_template_format_spec(self):
+        @cacheme(key='Spec:{n:>5}>{n:0>3}')
+        def cache_spec(n):
+            return n
+
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.assertEqual(cache_spec(7), 7)
+        self.assertEqual(pickle.loads(conn.hget('TEST:Spec:    7', '007')), 7)
+
+
+class BreakerTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def tearDown(self):
+        breaker.reset()
+        super().tearDown()
+
+    def broken_conn(self):
+        conn = MagicMock()
+        for method in ('srem', 'sadd', 'smembers', 'hget'):
+            getattr(conn, method).side_effect = redis.exceptions.ConnectionError()
+        conn.pipeline.return_value.execute.side_effect = redis.exceptions.ConnectionError()
+        return conn
+
+    def test_breaker(self):
+        cb = CircuitBreaker(2, reset_timeout=0.05)
+        error = MagicMock(side_effect=redis.exceptions.TimeoutError())
+        replay = MagicMock()
+
+        for i in range(2):
+            with self.assertRaises(CacheUnavailable):
+                cb.call(error)
+        self.assertEqual(cb.state, cb.OPEN)
+
+        ok = MagicMock(return_value=1)
+        with self.assertRaises(CacheUnavailable):
+            cb.call(ok)
+        ok.assert_not_called()
+        cb.guard(replay, 'key')
+        replay.assert_not_called()
+
+        time.sleep(0.06)
+        self.assertEqual(cb.call(ok), 1)
+        self.assertEqual(cb.state, cb.CLOSED)
+        replay.assert_called_once_with('key')
+        self.assertEqual(cb.metrics['rejected'], 2)
+        self.assertEqual(cb.metrics['replayed'], 1)
+
+    def test_breaker_probe_error(self):
+        cb = CircuitBreaker(1, reset_timeout=0)
+        with self.assertRaises(CacheUnavailable):
+            cb.call(MagicMock(side_effect=redis.exceptions.ConnectionError()))
+        with self.assertRaises(ValueError):
+            cb.call(MagicMock(side_effect=ValueError()))
+        self.assertEqual(cb.state, cb.OPEN)
+        self.assertEqual(cb.call(lambda: 1), 1)
+        self.assertEqual(cb.state, cb.CLOSED)
+
+    def test_replay_error(self):
+        cb = CircuitBreaker(1)
+        replay = MagicMock()
+        cb.defer(MagicMock(side_effect=ValueError(), __name__='broken'))
+        cb.defer(replay, 'key')
+        self.assertEqual(cb.call(lambda: 1), 1)
+        replay.assert_called_once_with('key')
+        self.assertEqual(len(cb.queue), 0)
+
+    def test_breaker_overflow(self):
+        flush = MagicMock()
+        cb = CircuitBreaker(1, queue_size=2, on_overflow=flush)
+        replay = MagicMock()
+        for i in range(3):
+            cb.defer(replay, i)
+        cb.call(lambda: None)
+        flush.assert_called_once_with()
+        replay.assert_not_called()
+
+    def test_breaker_latency(self):
+        cb = CircuitBreaker(1, latency=10)
+        cb.call(time.sleep, 0.02)
+        self.assertEqual(cb.state, cb.OPEN)
+        self.assertEqual(cb.metrics['slow'], 1)
+
+    @cacheme(
+        key='Breaker:{user.id}',
+        invalid_keys=lambda c: [c.user.cache_key],
+        invalid_models=[TestUser]
+    )
+    def cache_breaker(self, user):
+        self.calls += 1
+        return self.calls
+
+    def test_degraded(self):
+        user = TestUser.objects.create(name='test')
+        self.assertEqual(self.cache_breaker(user), 1)
+
+        conn = self.broken_conn()
+        with patch('django_cacheme.cache_model.get_redis_conn', return_value=conn):
+            with patch('django_cacheme.utils.get_redis_conn', return_value=conn):
+                user.save()
+                self.assertEqual(self.cache_breaker(user), 2)
+                self.assertEqual(self.cache_breaker(user), 3)
+        self.assertIn(('User:%s' % user.id,), [args for func, args in breaker.queue])
+
+        # recovered, invalidation is replayed
+        self.cache_breaker(user)
+        self.assertEqual(len(breaker.queue), 0)
+        self.assertEqual(self.cache_breaker(user), 4)
+        self.assertEqual(self.cache_breaker(user), 4)
+
+    def test_write_error_after_invalidation(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        user = TestUser.objects.create(name='test')
+        self.assertEqual(self.cache_breaker(user), 1)
+        user.save()
+
+        # delete mark is removed, then the write fails
+        broken = MagicMock(wraps=conn)
+        broken.pipeline.return_value.execute.side_effect = redis.exceptions.ConnectionError()
+        with patch('django_cacheme.cache_model.get_redis_conn', return_value=broken):
+            self.assertEqual(self.cache_breaker(user), 2)
+        breaker.replay()
+        self.assertTrue(conn.sismember('TEST:delete', 'TEST:Breaker:%s' % user.id))
+        self.assertEqual(self.cache_breaker(user), 3)
+
+
+class ComputeTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    @cacheme(key='Flight:{n}')
+    def cache_flight(self, n):
+        self.calls += 1
+        time.sleep(0.1)
+        return n
+
+    @cacheme(key='Thread:{n}', executor='thread')
+    def cache_thread(self, n):
+        return n, threading.current_thread().name
+
+    @cacheme(key='ThreadOuter:{n}', executor='thread')
+    def cache_thread_outer(self, n):
+        return threading.current_thread().name, self.cache_thread(n)
+
+    def test_single_flight(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.cache_flight(1)))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cacheme_tags['cache_flight'].flights, {})
+
+    def test_thread_executor(self):
+        n, name = self.cache_thread(1)
+        self.assertEqual(n, 1)
+        self.assertNotEqual(name, threading.current_thread().name)
+        self.assertEqual(self.cache_thread(1), (n, name))
+
+    def test_nested_thread_executor(self):
+        # all workers busy with outer calls, inner calls run inline
+        pool, slots = get_pool('thread')
+        results = []
+        threads = [
+            threading.Thread(target=lambda n=n: results.append(self.cache_thread_outer(n)))
+            for n in range(pool._max_workers * 2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(results), len(threads))
+        for name, (n, inner) in results:
+            self.assertEqual(name, inner)
+
+    def test_unknown_executor(self):
+        with self.assertRaises(ValueError):
+            cacheme(key=lambda c: 'typo', executor='proces')
+
+    def test_process_executor(self):
+        n, pid = cache_process(1)
+        self.assertEqual(n, 1)
+        self.assertNotEqual(pid, os.getpid())
+
+    def test_process_nested_miss(self):
+        # pool is forked while a miss of the inner key is in flight here,
+        # worker must not wait on its copy of that call
+        inner = cacheme_tags['cache_process_inner']
+        entry = executors.pools.pop('process', None)
+        if entry:
+            entry[1].shutdown()
+        inner.flights['TEST:ProcessInner:1'] = Future()
+        try:
+            future = submit('process', call_function, cacheme_tags['cache_process_outer'].name, (1,), {})
+            self.assertEqual(future.result(timeout=10)[0], 2)
+        finally:
+            inner.flights.clear()
+
+    def test_queue_full(self):
+        pool, slots = get_pool('thread')
+        acquired = 0
+        while slots.acquire(blocking=False):
+            acquired += 1
+        try:
+            self.assertIsNone(submit('thread', lambda: 1))
+            n, name = self.cache_thread(2)
+            self.assertEqual(name, threading.current_thread().name)
+        finally:
+            for i in range(acquired):
+                slots.release()
+
+
+class KeyspaceTestCase(BaseTestCase):
+
+    @cacheme(
+        key='Inspect:{n}>data',
+        invalid_keys=lambda c: ['Inspect:%s' % c.n],
+        tag='inspect',
+        timeout=100
+    )
+    def cache_inspect(self, n):
+        return 'x' * n
+
+    def test_inspect(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        for n in range(1, 5):
+            self.cache_inspect(n)
+        conn.unlink('TEST:Inspect:1', 'TEST:Inspect:2')
+        conn.sadd('TEST:delete', 'TEST:Inspect:1>data', 'TEST:Inspect:3>data')
+
+        stats = inspect_tag('inspect', batch=2)
+        self.assertEqual(stats['size'], 4)
+        self.assertEqual((stats['live'], stats['dead'], stats['pruned']), (2, 2, 0))
+        self.assertEqual(stats['dead_ratio'], 0.5)
+        self.assertEqual(stats['ttl']['<1h'], 2)
+        self.assertEqual(stats['bytes'], len(pickle.dumps('xxx')) + len(pickle.dumps('xxxx')))
+        self.assertEqual(stats['writes']['writes'], 4)
+
+        report = inspect_keyspace(['inspect'], prune=True)
+        self.assertEqual(report['tags'][0][1]['pruned'], 2)
+        self.assertEqual(report['delete']['pruned'], 1)
+        self.assertEqual(report['invalid']['sets'], 4)
+        self.assertEqual(report['invalid']['pruned'], 2)
+        self.assertEqual(cacheme_tags['inspect'].keys, {b'TEST:Inspect:3>data', b'TEST:Inspect:4>data'})
+        self.assertEqual(conn.smembers('TEST:delete'), {b'TEST:Inspect:3>data'})
+        self.assertEqual(conn.smembers('TEST:Inspect:1:invalid'), set())
+
+    def test_inspect_sample(self):
+        for n in range(1, 6):
+            self.cache_inspect(n)
+        self.assertEqual(inspect_tag('inspect', sample=2, batch=10)['entries'], 2)
+
+    def test_inspect_command_and_admin(self):
+        self.cache_inspect(1)
+        out = StringIO()
+        call_command('cacheme_inspect', 'inspect', stdout=out)
+        self.assertIn('keys: 1, sampled: 1, dead: 0', out.getvalue())
+        self.assertIn('invalid sets: 1', out.getvalue())
+
+        admin = InvalidationAdmin(model=Invalidation, admin_site=AdminSite())
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='test_admin', is_staff=True, is_superuser=True)
+        response = admin.keyspace_view(request)
+        self.assertIn('inspect', dict(response.context_data['report']['tags']))
+        self.assertNotIn('invalid', response.context_data['report'])
+
+        request = RequestFactory().get('/', {'sets': '1'})
+        request.user = User.objects.get(username='test_admin')
+        response = admin.keyspace_view(request)
+        self.assertEqual(response.context_data['report']['invalid']['sets'], 1)
+
+        request.user = User.objects.create(username='test_staff', is_staff=True)
+        with self.assertRaises(PermissionDenied):
+            admin.keyspace_view(request)
+
+    def test_inspect_max_sets(self):
+        for n in range(1, 4):
+            self.cache_inspect(n)
+        stats = inspect_keyspace(['inspect'], max_sets=2)['invalid']
+        self.assertEqual(stats['sets'], 2)
+        self.assertTrue(stats['truncated'])
+        self.assertFalse(inspect_keyspace(['inspect'], max_sets=0)['invalid']['truncated'])
+
+
+class RefreshTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    @contextmanager
+    def on_commit(self):
+        # run on_commit callbacks at exit, like captureOnCommitCallbacks of Django 3.2+
+        callbacks = []
+        with patch(
+            'django_cacheme.cache_model.transaction.on_commit',
+            side_effect=lambda func, using=None: callbacks.append(func)
+        ):
+            yield
+        for func in callbacks:
+            func()
+
+    @cacheme(
+        key='Refresh:{book.id}',
+        invalid_keys=lambda c: [c.book.cache_key],
+        invalid_models=[Book],
+        refresh_on={Book: lambda book: [(None, book)]}
+    )
+    def cache_refresh(self, book):
+        if self:
+            self.calls += 1
+        return book.name
+
+    @cacheme(
+        key='Refresh:bg:{user.id}',
+        refresh_on={TestUser: lambda user: [{'self': None, 'user': user}]},
+        refresh_mode='background'
+    )
+    def cache_refresh_bg(self, user):
+        return user.name
+
+    def test_refresh_on_commit(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        book = Book.objects.create(name='a')
+        self.assertEqual(self.cache_refresh(book), 'a')
+
+        with self.on_commit():
+            book.name = 'b'
+            book.save()
+            book.name = 'c'
+            book.save()
+            # not committed yet, only invalidated
+            self.assertEqual(pickle.loads(conn.hget('TEST:Refresh:%s' % book.id, 'base')), 'a')
+
+        self.assertEqual(pickle.loads(conn.hget('TEST:Refresh:%s' % book.id, 'base')), 'c')
+        self.assertFalse(conn.sismember('TEST:delete', 'TEST:Refresh:%s' % book.id))
+        self.assertEqual(self.cache_refresh(book), 'c')
+        self.assertEqual(self.calls, 1)
+
+    def test_refresh_error(self):
+        book = Book.objects.create(name='a')
+        with patch.object(cacheme_tags['cache_refresh'], 'set_many', side_effect=ValueError()):
+            with self.on_commit():
+                book.save()
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.assertTrue(conn.sismember('TEST:delete', 'TEST:Refresh:%s' % book.id))
+
+    def test_refresh_schedule_error(self):
+        book = Book.objects.create(name='a')
+        instance = cacheme_tags['cache_refresh']
+        with patch.dict(instance.refresh_on, {Book: MagicMock(side_effect=ValueError())}):
+            with self.on_commit():
+                book.save()
+
+    def test_refresh_pool_full(self):
+        user = TestUser.objects.create(name='a')
+        instance = cacheme_tags['cache_refresh_bg']
+        with patch('django_cacheme.cache_model.submit', return_value=None):
+            with patch('django_cacheme.cache_model.close_old_connections') as close:
+                with self.on_commit():
+                    user.save()
+                close.assert_not_called()
+        self.assertEqual(instance.refreshing, set())
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        self.assertEqual(pickle.loads(conn.hget('TEST:Refresh:bg:%s' % user.id, 'base')), 'a')
+
+    def test_refresh_background(self):
+        conn = get_redis_connection(settings.CACHEME['REDIS_CACHE_ALIAS'])
+        user = TestUser.objects.create(name='a')
+        with self.on_commit():
+            user.name = 'b'
+            user.save()
+
+        for i in range(100):
+            value = conn.hget('TEST:Refresh:bg:%s' % user.id, 'base')
+            if value:
+                break
+            time.sleep(0.01)
+        self.assertEqual(pickle.loads(value), 'b')
+        self.assertEqual(cacheme_tags['cache_refresh_bg'].refreshing, set())